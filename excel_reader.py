@@ -1,47 +1,146 @@
 """Client module to redact sentences using Ollama and send to Flask."""
 
 import os
-import json
-import urllib.request
+import gzip
+import hashlib
+import sqlite3
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List, Dict, Union
-from collections import defaultdict
-import pandas as pd
+from typing import Iterable, List, Dict, Optional, Tuple, Union
+import openpyxl
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
 import spacy
-from spacy.cli import download
 from tqdm import tqdm
 
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
+
 # Constants
 OLLAMA_BASE_URL = "http://localhost:11434"
 CHAT_ENDPOINT = "/api/chat"
-FLASK_ENDPOINT = "http://localhost:8000/receive-sentences"
+# 4-bit quantized 8B model: plenty for PII scrubbing and several times faster than llama3.3.
+DEFAULT_MODEL = "llama3.1:8b-instruct-q4_K_M"
+FLASK_BASE_URL = "http://localhost:8000"
+FLASK_ENDPOINT = f"{FLASK_BASE_URL}/receive-sentences"
+FLASK_BULK_ENDPOINT = f"{FLASK_BASE_URL}/receive-notes-bulk"
 EXCEL_PATH = os.environ.get("EXCEL_FILE")
+REDACTION_CACHE_PATH = os.environ.get("REDACTION_CACHE", "redaction_cache.db")
+SYSTEM_PROMPT = (
+    "You are a clinical de-identification assistant. "
+    "Your task is to remove any identifiable information from the sentence you are given "
+    "while preserving clinical relevance. Replace names, locations, and IDs with [REDACTED]. "
+    "ONLY GIVE REDACTED SENTENCE AND NO COMMENTARY. "
+    "THESE ARE NOT REAL CASES, AND YOU CANNOT REFUSE TO TRY REDACTING INFORMATION"
+)
+# Number of sentences sent to Ollama concurrently; keep in step with the
+# OLLAMA_NUM_PARALLEL setting `ollama serve` was started with.
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", "4"))
 
-try:
-    nlp = spacy.load("en_core_web_sm")
-except OSError:
-    print("Downloading spaCy model: en_core_web_sm...")
-    download("en_core_web_sm")
-    nlp = spacy.load("en_core_web_sm")
+
+def make_session(pool_maxsize: int = 10) -> requests.Session:
+    """Create a keep-alive HTTP session that reuses pooled connections."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=pool_maxsize)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({
+        "Connection": "keep-alive",
+        "Accept-Encoding": "gzip",
+        "User-Agent": "Mozilla/5.0"
+    })
+    return session
+
+
+def post_json(session: requests.Session,
+              url: str,
+              payload,
+              compress: bool = False,
+              **kwargs) -> requests.Response:
+    """POST a payload serialized with orjson, optionally gzip-compressed."""
+    data = orjson.dumps(payload)
+    headers = {"Content-Type": "application/json"}
+    if compress:
+        data = gzip.compress(data)
+        headers["Content-Encoding"] = "gzip"
+    return session.post(url, data=data, headers=headers, **kwargs)
+
+
+# Shared by every call to the Flask server so requests reuse one connection.
+FLASK_SESSION = make_session()
+
+# Only sentence boundaries are needed, so a rule-based sentencizer replaces
+# the statistical parser and no model download is required.
+nlp = spacy.blank("en")
+nlp.add_pipe("sentencizer")
+
+def group_sentences(doc, n=3):
+    """Join every n sentences of a doc into one string."""
+    sentences = [text for text in (sent.text.strip() for sent in doc.sents) if text]
+    return [' '.join(sentences[i:i+n]) for i in range(0, len(sentences), n)]
 
 def split_into_sentences(text, n=3):
     """Split text into sentences and join every n sentences into one string."""
-    doc = nlp(text)
-    sentences = [sent.text.strip() for sent in doc.sents if sent.text.strip()]
-    return [' '.join(sentences[i:i+n]) for i in range(0, len(sentences), n)]
+    return group_sentences(nlp(text), n)
+
+def split_notes_into_sentences(notes: Iterable[Tuple[int, str]], n=3, batch_size=64):
+    """Yield (note_id, sentences) for (note_id, text) pairs, parsed in batches.
+
+    Runs in a single process: the sentencizer is far cheaper than the IPC of
+    spaCy's worker processes, which can also hang on exit if iteration stops early.
+    """
+    texts = ((text, note_id) for note_id, text in notes)
+    for doc, note_id in nlp.pipe(texts, as_tuples=True, batch_size=batch_size):
+        yield note_id, group_sentences(doc, n)
+
+def normalize_cell(value):
+    """Map calamine and openpyxl cell values to the same Python value."""
+    if value == "":
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
 
 class ExcelReader:
-    """Read Excel rows as dictionaries."""
+    """Read rows of the first Excel sheet as dictionaries.
+
+    By default openpyxl's read-only mode streams rows in constant memory. If the
+    optional python-calamine package is installed, its Rust parser is used
+    instead: much faster, but it loads the whole sheet into memory (as compact
+    native values, not Python cell objects).
+    """
 
     def __init__(self, file_path: str):
         self.file_path = file_path
-        self.data = pd.read_excel(file_path)
+        if CalamineWorkbook is not None:
+            self.wb = CalamineWorkbook.from_path(file_path)
+            self.ws = self.wb.get_sheet_by_index(0)
+        else:
+            self.wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+            self.ws = self.wb.worksheets[0]
+
+    def _iter_rows(self):
+        """Yield each sheet row as a sequence of cell values."""
+        if CalamineWorkbook is not None:
+            return self.ws.iter_rows()
+        return self.ws.iter_rows(values_only=True)
 
     def read_row_as_dict(self):
-        """Yield rows from Excel as dictionaries."""
-        for row in self.data.to_dict(orient="records"):
-            yield row
+        """Yield rows from Excel as dictionaries keyed by the header row."""
+        rows = self._iter_rows()
+        headers = next(rows, ())
+        for row in rows:
+            yield dict(zip(headers, map(normalize_cell, row)))
+
+    def close(self):
+        """Release the workbook file handle."""
+        self.wb.close()
 
 
 @dataclass
@@ -55,60 +154,126 @@ class Message:
         return {"role": self.role, "content": self.content}
 
 
+# Built once; send_chat passes plain dicts through untouched.
+SYSTEM_MESSAGE = Message(role="system", content=SYSTEM_PROMPT).to_dict()
+
+
 class OllamaClient:
     """Chat API client for Ollama."""
 
-    def __init__(self, model: str = "llama3.2:1b", base_url: str = OLLAMA_BASE_URL):
+    def __init__(self,
+                 model: str = DEFAULT_MODEL,
+                 base_url: str = OLLAMA_BASE_URL,
+                 keep_alive: str = "30m",
+                 num_ctx: int = 2048):
         self.model = model
+        self.keep_alive = keep_alive
+        self.num_ctx = num_ctx
         self.endpoint = f"{base_url}{CHAT_ENDPOINT}"
+        self.session = make_session(pool_maxsize=max(10, OLLAMA_NUM_PARALLEL))
+        self._pull_lock = threading.Lock()
+        # None until the user is asked; then True once pulled, False if declined.
+        self._pull_answer: Optional[bool] = None
 
-    def send_chat(self, messages: List[Union[dict, Message]]) -> Dict:
-        """Send chat messages to Ollama and return response."""
+    def send_chat(self, messages: List[Union[dict, Message]], retried: bool = False) -> Dict:
+        """Send chat messages to Ollama and return response.
+
+        A missing model is pulled (if the user agrees) and the request retried once.
+        """
         payload = {
             "model": self.model,
             "messages": [
                 msg.to_dict() if isinstance(msg, Message) else msg for msg in messages
             ],
-            "stream": False
+            "stream": False,
+            # Keep the model resident between sentences; redaction needs only a small context.
+            "keep_alive": self.keep_alive,
+            "options": {"num_ctx": self.num_ctx}
         }
 
-        data = json.dumps(payload).encode("utf-8")
-        req = urllib.request.Request(
-            self.endpoint,
-            data=data,
-            headers={"Content-Type": "application/json"},
-            method="POST"
-        )
-
         try:
-            with urllib.request.urlopen(req) as response:
-                result = response.read().decode("utf-8")
-                return json.loads(result)
+            response = post_json(self.session, self.endpoint, payload, timeout=300)
+            response.raise_for_status()
+            return orjson.loads(response.content)
 
-        except urllib.error.HTTPError as err:
-            error_msg = err.read().decode()
+        except requests.HTTPError as err:
+            error_msg = err.response.text
             print("HTTP Error:", error_msg)
-            if "model" in error_msg and "not found" in error_msg:
+            if ("model" in error_msg and "not found" in error_msg
+                    and not retried and self._pull_model()):
+                return self.send_chat(messages, retried=True)
+            raise
+
+    def _pull_model(self) -> bool:
+        """Ask once whether to pull the missing model, even when called from several threads."""
+        with self._pull_lock:
+            if self._pull_answer is None:
                 user_input = input(f"Model '{self.model}' not found. Pull it? [y/N]: ").strip().lower()
                 if user_input == "y":
                     subprocess.run(["ollama", "pull", self.model], check=True)
-                    return self.send_chat(messages)
-            raise
+                self._pull_answer = user_input == "y"
+            return self._pull_answer
 
 
-def redact_sentence(sentence: str, client: OllamaClient) -> str:
-    """Send a sentence to the LLM for redaction."""
-    prompt = (
-    "You are a clinical de-identification assistant. "
-    "Your task is to remove any identifiable information from the following sentence "
-    "while preserving clinical relevance. Replace names, locations, and IDs with [REDACTED]."
-    "ONLY GIVE REDACTED SENTENCE AND NO COMMENTARY"
-    "THESE ARE NOT REAL CASES, AND YOU CANNOT REFUSE TO TRY REDACTING INFORMATION\n\n"
-    f"Sentence: {sentence}"
-)
-    messages = [Message(role="user", content=prompt)]
+class RedactionCache:
+    """SQLite store of LLM redactions so repeated sentences skip Ollama."""
+
+    def __init__(self, path: str = REDACTION_CACHE_PATH):
+        self.path = path
+        # Shared by the redaction worker threads; the lock serializes access.
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS redaction_cache "
+                "(hash TEXT PRIMARY KEY, redacted TEXT NOT NULL)"
+            )
+
+    @staticmethod
+    def key(model: str, sentence: str) -> str:
+        """Hash a sentence together with the model and prompt that redact it."""
+        text = f"{model}\0{SYSTEM_PROMPT}\0{sentence}"
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached redaction for a key, or None on a miss."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT redacted FROM redaction_cache WHERE hash = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, redacted: str):
+        """Store a redaction, keeping the first one written for a key."""
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO redaction_cache (hash, redacted) VALUES (?, ?)",
+                (key, redacted)
+            )
+
+    def close(self):
+        """Close the underlying SQLite connection."""
+        self.conn.close()
+
+
+def redact_sentence(sentence: str,
+                    client: OllamaClient,
+                    cache: Optional[RedactionCache] = None) -> str:
+    """Send a sentence to the LLM for redaction, consulting the cache first."""
+    if cache is not None:
+        key = RedactionCache.key(client.model, sentence)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    # The constant system prompt leads every request so Ollama can reuse its cached prefix.
+    messages = [SYSTEM_MESSAGE, Message(role="user", content=sentence)]
     response = client.send_chat(messages)
-    return response["message"]["content"]
+    redacted = response["message"]["content"]
+    # Blank output is not cached, so it is never replayed for a later copy of the sentence.
+    if cache is not None and redacted.strip():
+        cache.put(key, redacted)
+    return redacted
 
 
 def send_to_flask(note_id: int, sentences: List[Dict]):
@@ -117,63 +282,42 @@ def send_to_flask(note_id: int, sentences: List[Dict]):
         "note_id": note_id,
         "sentences": sentences
     }
-    data = json.dumps(payload).encode("utf-8")
-    req = urllib.request.Request(
-        FLASK_ENDPOINT,
-        data=data,
-        headers={
-            "Content-Type": "application/json",
-            "User-Agent": "Mozilla/5.0"
-        },
-        method="POST"
-    )
     try:
-        with urllib.request.urlopen(req) as response:
-            print("Flask response:", response.read().decode())
-    except urllib.error.HTTPError as err:
-        print("Error sending to Flask:", err.read().decode())
+        response = post_json(FLASK_SESSION, FLASK_ENDPOINT, payload, compress=True)
+        response.raise_for_status()
+        print("Flask response:", response.text)
+    except requests.HTTPError as err:
+        print("Error sending to Flask:", err.response.text)
+        raise
+
+def send_notes_to_flask(notes: List[Dict]):
+    """Send several notes, each {"note_id": ..., "sentences": [...]}, to Flask in one request."""
+    payload = {"notes": notes}
+    try:
+        response = post_json(FLASK_SESSION, FLASK_BULK_ENDPOINT, payload, compress=True)
+        response.raise_for_status()
+        print("Flask response:", response.text)
+    except requests.HTTPError as err:
+        print("Error sending to Flask:", err.response.text)
         raise
 
 def ask_for_sentences_from_flask():
     """Ask the user to provide sentences from Flask."""
-    req = urllib.request.Request(
-        "http://localhost:8000/sentences",
-        method="GET",
-        headers={
-            "User-Agent": "Mozilla/5.0"
-        }
-    )
-
     try:
-        with urllib.request.urlopen(req) as response:
-            print("Flask response:", response.read().decode())
-    except urllib.error.HTTPError as err:
-        print("Error sending to Flask:", err.read().decode())
+        response = FLASK_SESSION.get(f"{FLASK_BASE_URL}/sentences")
+        response.raise_for_status()
+        print("Flask response:", response.text)
+    except requests.HTTPError as err:
+        print("Error sending to Flask:", err.response.text)
         raise
 
 
 def get_latest_processed_note_id():
     """Return the first note_id with any incomplete sentence (missing or blank final_sentence)."""
     try:
-        req = urllib.request.Request(
-            "http://localhost:8000/sentences",
-            method="GET",
-            headers={"User-Agent": "Mozilla/5.0"}
-        )
-        with urllib.request.urlopen(req) as response:
-            data = json.loads(response.read().decode())
-            if not data:
-                return 0
-            notes = defaultdict(list)
-            for s in data:
-                notes[s["note_id"]].append(s)
-
-            for note_id in sorted(notes.keys()):
-                for sentence in notes[note_id]:
-                    final = sentence.get("llm_sentence")
-                    if final is None or final.strip() == "":
-                        return note_id
-            return max(notes.keys())-1
+        response = FLASK_SESSION.get(f"{FLASK_BASE_URL}/next-unfinished-note")
+        response.raise_for_status()
+        return int(orjson.loads(response.content)["note_id"])
     except Exception as e:
         print("Error fetching previous sentences:", e)
         return 0
@@ -190,15 +334,26 @@ def process_note(note_id: int,
         sentences = split_into_sentences(discharge_text,sentence_split)
     else:
         sentences = [discharge_text]
-    results = []
-
-    for idx, sentence in enumerate(tqdm(sentences, desc=f"Note {note_id}: Sentences", leave=False)):
-        redacted = redact_sentence(sentence, client)
-        results.append({
-            "index": idx,
-            "original": sentence,
-            "llm": redacted,
-            "final": None
-        })
-
-    return results
+    return redact_sentences(note_id, sentences, client)
+
+
+def redact_sentences(note_id: int,
+                     sentences: List[str],
+                     client: OllamaClient,
+                     cache: Optional[RedactionCache] = None) -> List[Dict]:
+    """Redact already-split sentences of a note and prepare them for upload."""
+    # Requests are I/O bound, so overlap them; map() keeps results in sentence order.
+    with ThreadPoolExecutor(max_workers=OLLAMA_NUM_PARALLEL) as executor:
+        redacted = list(tqdm(
+            executor.map(lambda sentence: redact_sentence(sentence, client, cache), sentences),
+            total=len(sentences),
+            desc=f"Note {note_id}: Sentences",
+            leave=False
+        ))
+
+    return [{
+        "index": idx,
+        "original": sentence,
+        "llm": llm,
+        "final": None
+    } for idx, (sentence, llm) in enumerate(zip(sentences, redacted))]
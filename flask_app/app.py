@@ -1,7 +1,14 @@
 """Flask app for handling note de-identification and sentence-level storage."""
 
-from flask import Flask, request, jsonify, render_template
+import sqlite3
+import zlib
+
+import orjson
+from flask import Flask, current_app, request, jsonify, render_template
+from flask.json.provider import JSONProvider
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
 # SQLAlchemy setup
 db = SQLAlchemy()
@@ -20,17 +27,95 @@ class Note(db.Model):
 # pylint: disable=too-few-public-methods
 class Sentence(db.Model):
     """Table storing per-sentence de-identification mappings."""
+    __table_args__ = (
+        # Partial index so /next-sentence seeks straight to unreviewed rows.
+        db.Index("ix_sentence_unreviewed", "id", sqlite_where=db.text("final_sentence IS NULL")),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    note_id = db.Column(db.Integer, db.ForeignKey('note.note_id'), nullable=False)
+    note_id = db.Column(db.Integer, db.ForeignKey('note.note_id'), nullable=False, index=True)
     sentence_index = db.Column(db.Integer, nullable=False)
     original_sentence = db.Column(db.Text, nullable=False)
     llm_sentence = db.Column(db.Text, nullable=True)
     final_sentence = db.Column(db.Text, nullable=True)
 
+# ------------------- Helpers -------------------
+class ORJSONProvider(JSONProvider):
+    """JSON provider that (de)serializes request and response bodies with orjson."""
+
+    def dumps(self, obj, **kwargs):
+        """Serialize obj to a JSON string."""
+        return orjson.dumps(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        """Deserialize JSON from str or bytes."""
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        """Build a JSON response from orjson's bytes without a str round trip."""
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
+def sentence_rows(note_id, sentences):
+    """Build Sentence insert rows for a note, or return None if an entry is malformed."""
+    if not isinstance(sentences, list) or any(
+            not isinstance(entry, dict) or "index" not in entry or "original" not in entry
+            for entry in sentences):
+        return None
+
+    return [{
+        "note_id": note_id,
+        "sentence_index": entry["index"],
+        "original_sentence": entry["original"],
+        "llm_sentence": entry.get("llm")
+        # final_sentence intentionally excluded
+    } for entry in sentences]
+
+def note_rows(note):
+    """Build Sentence insert rows for one bulk-upload note, or return None if it is malformed."""
+    if not isinstance(note, dict) or not note.get("note_id") or not note.get("sentences"):
+        return None
+    return sentence_rows(note["note_id"], note["sentences"])
+
+# Upper bound on a gunzipped request body when MAX_CONTENT_LENGTH is not configured.
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+
+def read_json_payload():
+    """Parse the request body as a JSON object, gunzipping it first if gzip-encoded.
+
+    Returns None when the body cannot be decoded or decompresses past the size limit.
+    """
+    raw = request.get_data()
+    try:
+        if request.headers.get("Content-Encoding") == "gzip":
+            limit = current_app.config.get("MAX_CONTENT_LENGTH") or MAX_DECOMPRESSED_SIZE
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)  # expect a gzip header
+            # Inflate at most one byte past the limit so oversized bodies are detected cheaply.
+            raw = decompressor.decompress(raw, limit + 1)
+            if len(raw) > limit or not decompressor.eof:
+                return None
+        payload = orjson.loads(raw)
+    except (zlib.error, orjson.JSONDecodeError):
+        return None
+    return payload if isinstance(payload, dict) else None
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, _connection_record):
+    """Tune every new SQLite connection for concurrent reads during pipeline writes."""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")    # readers don't block the writer
+    cursor.execute("PRAGMA synchronous=NORMAL")  # fsync at checkpoints, not every commit
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-64000")   # ~64 MB page cache
+    cursor.close()
+
 # ------------------- App Factory -------------------
 def create_app():
     """Initialize the Flask app with database and routes."""
     app = Flask(__name__, template_folder="templates", static_folder="static")
+    app.json = ORJSONProvider(app)
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///my.db'
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     db.init_app(app)
@@ -47,29 +132,46 @@ def create_app():
     @app.route("/receive-sentences", methods=["POST"])
     def receive_sentences():
         """Receive and store sentence-level de-identification data."""
-        payload = request.get_json()
+        payload = read_json_payload()
+        if payload is None:
+            return jsonify(error="Request body must be a JSON object"), 400
         note_id = payload.get("note_id")
         sentences = payload.get("sentences")
 
         if not note_id or not sentences:
             return jsonify(error="Missing 'note_id' or 'sentences'"), 400
 
-        for entry in sentences:
-            if "index" not in entry or "original" not in entry:
-                return jsonify(error="Each sentence must have 'index' and 'original'"), 400
-
-            sentence = Sentence(
-                note_id=note_id,
-                sentence_index=entry["index"],
-                original_sentence=entry["original"],
-                llm_sentence=entry.get("llm")
-                # final_sentence intentionally excluded
-            )
-            db.session.add(sentence)
+        rows = sentence_rows(note_id, sentences)
+        if rows is None:
+            return jsonify(error="Each sentence must have 'index' and 'original'"), 400
 
+        # One multi-row INSERT instead of an ORM add() per sentence.
+        db.session.execute(Sentence.__table__.insert(), rows)
         db.session.commit()
         return jsonify(message="Sentences stored"), 200
 
+    @app.route("/receive-notes-bulk", methods=["POST"])
+    def receive_notes_bulk():
+        """Receive and store sentence-level data for several notes at once."""
+        payload = read_json_payload()
+        if payload is None:
+            return jsonify(error="Request body must be a JSON object"), 400
+        notes = payload.get("notes")
+
+        if not notes or not isinstance(notes, list):
+            return jsonify(error="Missing 'notes' list"), 400
+
+        rows_per_note = [note_rows(note) for note in notes]
+        if any(rows is None for rows in rows_per_note):
+            return jsonify(error="Each note must have 'note_id' and 'sentences', "
+                                 "and each sentence 'index' and 'original'"), 400
+
+        # A single INSERT and commit covers every note in the batch.
+        db.session.execute(Sentence.__table__.insert(),
+                           [row for rows in rows_per_note for row in rows])
+        db.session.commit()
+        return jsonify(message=f"Sentences stored for {len(notes)} notes"), 200
+
     @app.route("/sentence/<int:sentence_id>", methods=["PATCH"])
     def update_sentence(sentence_id):
         """Update the final version of a specific sentence."""
@@ -105,8 +207,13 @@ def create_app():
 
     @app.route("/sentences", methods=["GET"])
     def get_sentences():
-        """Return all sentences."""
-        sentences = Sentence.query.all()
+        """Return a page of sentences, selected with ?limit= and ?offset=."""
+        limit = request.args.get("limit", 1000, type=int)
+        offset = request.args.get("offset", 0, type=int)
+        if limit < 0 or offset < 0:
+            return jsonify(error="'limit' and 'offset' must be non-negative"), 400
+
+        sentences = Sentence.query.order_by(Sentence.id).limit(limit).offset(offset)
         return jsonify([{
             "id": sentence.id,
             "note_id": sentence.note_id,
@@ -116,9 +223,26 @@ def create_app():
             "final_sentence": sentence.final_sentence
         } for sentence in sentences]), 200
 
+    @app.route("/next-unfinished-note", methods=["GET"])
+    def get_next_unfinished_note():
+        """Return the note_id the redaction pipeline should resume after."""
+        # First note with a missing LLM sentence; if all are complete, resume from the
+        # last note received; 0 for an empty table. Both aggregates use ix_sentence_note_id.
+        note_id = db.session.execute(db.text(
+            "SELECT COALESCE("
+            "(SELECT MIN(note_id) FROM sentence"
+            " WHERE llm_sentence IS NULL OR TRIM(llm_sentence) = ''),"
+            " (SELECT MAX(note_id) - 1 FROM sentence),"
+            " 0)"
+        )).scalar()
+        return jsonify(note_id=note_id), 200
+
     # ------------------- Setup DB -------------------
     with app.app_context():
         db.create_all()
+        # create_all() skips tables that already exist, so add any new indexes explicitly.
+        for index in Sentence.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
 
     return app
 
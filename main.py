@@ -2,43 +2,97 @@
 """Main entry point for redaction pipeline and Flask server."""
 
 import argparse
+import signal
 import subprocess
 import time
 import os
+from itertools import islice
 from tqdm import tqdm
-from excel_reader import OllamaClient, ExcelReader, \
+import requests
+from excel_reader import DEFAULT_MODEL, FLASK_BASE_URL, FLASK_SESSION, \
+    OllamaClient, ExcelReader, RedactionCache, \
 get_latest_processed_note_id,\
-    process_note,send_to_flask
+    redact_sentences, send_notes_to_flask, split_notes_into_sentences
 
 
 
 def run_flask_subprocess():
     """Start Flask app in a subprocess."""
+    # Output is discarded rather than piped: an undrained pipe fills up and blocks the server.
+    # A separate session keeps Ctrl+C from reaching the server before pending notes are uploaded.
     return subprocess.Popen(
         ["python", os.path.join("flask_app", "app.py")],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True
     )
 
 
+def stop_flask(flask_proc: subprocess.Popen):
+    """Terminate the Flask server's process group, including the debug reloader's child."""
+    if flask_proc.poll() is None:
+        try:
+            os.killpg(flask_proc.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        flask_proc.wait()
 
-def run_redaction_pipeline(file_path: str):
-    """Process the Excel file and send redacted data to the Flask server."""
-    client = OllamaClient(model="llama3.3")
+
+def wait_for_flask(flask_proc: subprocess.Popen, timeout: float = 30.0) -> bool:
+    """Poll the Flask server until it responds, the process exits, or timeout passes."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and flask_proc.poll() is None:
+        try:
+            if FLASK_SESSION.get(f"{FLASK_BASE_URL}/", timeout=1).ok:
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    return False
+
+
+
+def run_redaction_pipeline(file_path: str, model: str = DEFAULT_MODEL, batch_size: int = 16):
+    """Process the Excel file and send redacted data to the Flask server.
+
+    Redacted notes are buffered and uploaded batch_size at a time.
+    """
+    client = OllamaClient(model=model)
     reader = ExcelReader(file_path)
-    latest_note_id = get_latest_processed_note_id()
-    all_rows = list(reader.read_row_as_dict())
-    for idx, row in enumerate(tqdm(all_rows, desc="Processing Notes")):
-        note_id = idx + 1
-        if note_id <= latest_note_id:
-            continue
-        discharge_text = row.get("Discharge Summary", "")
-        if not discharge_text.strip():
-            continue
-
-        print(f"\n🔍 Note {note_id}: splitting into sentences...")
-        redacted_sentences = process_note(note_id, discharge_text, client, True, 5)
-        send_to_flask(note_id, redacted_sentences)
+    cache = RedactionCache()
+    latest_note_id = max(0, get_latest_processed_note_id())
+    # Skip notes the server already has at the iterator layer; note ids are 1-based row numbers.
+    rows = islice(reader.read_row_as_dict(), latest_note_id, None)
+    notes = (
+        (note_id, str(row.get("Discharge Summary") or ""))
+        for note_id, row in enumerate(rows, start=latest_note_id + 1)
+    )
+    notes = ((note_id, text) for note_id, text in notes if text.strip())
+    pending = []
+    try:
+        # Stream the remaining notes through spaCy in batches rather than one nlp() call per note.
+        for note_id, sentences in tqdm(split_notes_into_sentences(notes, 5),
+                                       desc="Processing Notes"):
+            print(f"\n🔍 Note {note_id}: redacting {len(sentences)} sentences...")
+            redacted_sentences = redact_sentences(note_id, sentences, client, cache)
+            pending.append({"note_id": note_id, "sentences": redacted_sentences})
+            if len(pending) >= batch_size:
+                send_notes_to_flask(pending)
+                pending = []
+    except BaseException:
+        # Stopped early (e.g. Ctrl+C): upload what finished without masking the original error.
+        if pending:
+            try:
+                send_notes_to_flask(pending)
+            except requests.RequestException as err:
+                print(f"Dropped {len(pending)} redacted notes that could not be uploaded: {err}")
+        raise
+    else:
+        if pending:
+            send_notes_to_flask(pending)
+    finally:
+        reader.close()
+        cache.close()
 
 def main():
     """Main loop logic."""
@@ -47,20 +101,27 @@ def main():
         "-f", "--filepath", type=str, required=True,
         help="Path to Excel file containing discharge summaries"
     )
+    parser.add_argument(
+        "-m", "--model", type=str, default=DEFAULT_MODEL,
+        help=f"Ollama model used for redaction (default: {DEFAULT_MODEL})"
+    )
     args = parser.parse_args()
 
     flask_proc = run_flask_subprocess()
     print(f"Started Flask server (PID: {flask_proc.pid})")
-    time.sleep(1)  # give Flask time to start
 
     try:
-        run_redaction_pipeline(args.filepath)
+        if not wait_for_flask(flask_proc):
+            raise SystemExit("Flask server failed to start.")
+        run_redaction_pipeline(args.filepath, args.model)
         print("Redaction pipeline complete.")
         print("Flask server is still running. Press Ctrl+C to quit when ready.")
-        while True:
-            time.sleep(1)
+        flask_proc.wait()
     except KeyboardInterrupt:
         print("Interrupted by user.")
+    finally:
+        # The server runs in its own session, so it must be stopped explicitly.
+        stop_flask(flask_proc)
 
 
 if __name__ == "__main__":